@@ -0,0 +1,132 @@
+# Note: These sketches are used to audit OpenStreetMap extracts too large to audit
+# exactly in memory. Each sketch uses a fixed amount of memory regardless of the
+# size of the input, and sketches built on different shards of the data can be
+# merged into one sketch of the whole dataset.
+
+import hashlib
+import math
+
+
+def hash128(value):
+    '''Hash a string to a 128-bit integer'''
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest(), 'big')
+
+
+class HyperLogLog(object):
+    '''Estimate the number of distinct values with 2 ** p one-byte registers
+
+    The relative standard error of the estimate is 1.04 / sqrt(2 ** p),
+    e.g. about 0.8% with p = 14 (16 KB of registers).
+    '''
+
+    def __init__(self, p=14):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m)
+
+    def add(self, value):
+        x = hash128(value) >> 64 # Only the first 64 bits are used
+        index = x >> (64 - self.p)
+        rest = x & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1 # Position of the leftmost 1-bit
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros:
+            estimate = self.m * math.log(self.m / zeros) # Linear counting for small cardinalities
+        return int(round(estimate))
+
+    def error(self):
+        '''Relative standard error of count()'''
+        return 1.04 / math.sqrt(self.m)
+
+    def merge(self, other):
+        if self.p != other.p:
+            raise ValueError('Cannot merge HyperLogLogs with different precisions')
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+        return self
+
+
+class CountMinSketch(object):
+    '''Estimate the counts of values in a depth x width table of counters
+
+    With width = ceil(e / epsilon) and depth = ceil(ln(1 / delta)), an estimate is never
+    below the true count, and exceeds it by at most epsilon * total with probability 1 - delta.
+    '''
+
+    def __init__(self, epsilon=0.001, delta=0.01):
+        self.epsilon = epsilon
+        self.delta = delta
+        self.width = int(math.ceil(math.e / epsilon))
+        self.depth = int(math.ceil(math.log(1 / delta)))
+        self.table = [[0] * self.width for _ in range(self.depth)]
+        self.total = 0
+
+    def _columns(self, value):
+        # Derive one column per row from two 64-bit hashes (Kirsch-Mitzenmacher)
+        x = hash128(value)
+        h1, h2 = x >> 64, x & 0xFFFFFFFFFFFFFFFF
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, value, count=1):
+        for row, column in zip(self.table, self._columns(value)):
+            row[column] += count
+        self.total += count
+
+    def estimate(self, value):
+        return min(row[column] for row, column in zip(self.table, self._columns(value)))
+
+    def error(self):
+        '''Maximum overestimate of estimate(), with probability 1 - delta'''
+        return self.epsilon * self.total
+
+    def merge(self, other):
+        if (self.width, self.depth) != (other.width, other.depth):
+            raise ValueError('Cannot merge CountMinSketches with different dimensions')
+        for row, other_row in zip(self.table, other.table):
+            for column, count in enumerate(other_row):
+                row[column] += count
+        self.total += other.total
+        return self
+
+
+class TopK(object):
+    '''Track the k most frequent values (heavy hitters) with a CountMinSketch
+
+    Only the k current candidates are kept besides the sketch, so their counts
+    have the same error bound as CountMinSketch.estimate().
+    '''
+
+    def __init__(self, k=20, epsilon=0.001, delta=0.01):
+        self.k = k
+        self.sketch = CountMinSketch(epsilon, delta)
+        self.candidates = {}
+
+    def add(self, value, count=1):
+        self.sketch.add(value, count)
+        estimate = self.sketch.estimate(value)
+        if value in self.candidates or len(self.candidates) < self.k:
+            self.candidates[value] = estimate
+        else:
+            smallest = min(self.candidates, key=self.candidates.get)
+            if estimate > self.candidates[smallest]:
+                del self.candidates[smallest]
+                self.candidates[value] = estimate
+
+    def top(self):
+        '''Return a list of (value, estimated count), most frequent first'''
+        return sorted(self.candidates.items(), key=lambda item: item[1], reverse=True)
+
+    def error(self):
+        return self.sketch.error()
+
+    def merge(self, other):
+        self.sketch.merge(other.sketch)
+        candidates = set(self.candidates) | set(other.candidates)
+        estimates = {value: self.sketch.estimate(value) for value in candidates}
+        self.candidates = dict(sorted(estimates.items(), key=lambda item: item[1], reverse=True)[:self.k])
+        return self